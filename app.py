@@ -1,9 +1,18 @@
 import streamlit as st
-import json
-import requests
-import io
-import wave
+import orjson
+import asyncio
+import threading
+import collections
+import hashlib
+import re
+import itertools
+import contextlib
+import functools
+import httpx
 import base64
+import struct
+
+from voice_input import voice_input
 
 # Set up the page configuration
 st.set_page_config(
@@ -20,127 +29,491 @@ st.set_page_config(
 # --- Gemini API Configuration ---
 TEXT_GENERATION_MODEL = "gemini-2.5-flash-preview-05-20"
 TTS_MODEL = "gemini-2.5-flash-preview-tts"
+TTS_VOICE = "Puck" # Upbeat voice
+TTS_MAX_CONCURRENT_REQUESTS = 4
+# Story text is narrated one paragraph per TTS request
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+# Fixed parts of every request. These are sent inline, not through context
+# caching (cachedContents): Gemini only caches content of at least ~1,000 tokens,
+# far more than this system prompt, and Gemini 2.5 already reuses repeated
+# prompt prefixes through implicit caching.
+# System prompt for bedtime stories
+STORY_SYSTEM_INSTRUCTION = {
+    "parts": [{"text": "You are a gentle and soothing storyteller, specializing in creating calming and imaginative bedtime stories for children. The stories should be a few paragraphs long and have a happy, reassuring ending."}]
+}
+TTS_GENERATION_CONFIG = {
+    "responseModalities": ["AUDIO"],
+    "speechConfig": {
+        "voiceConfig": {
+            "prebuiltVoiceConfig": {"voiceName": TTS_VOICE}
+        }
+    }
+}
+
+# --- Shared async runtime and HTTP client ---
+# Streamlit re-executes this script on every interaction, so the event loop and
+# the HTTP client bound to it are kept alive with st.cache_resource. Reusing one
+# HTTP/2 client keeps the connection to the Gemini API alive between the story
+# and TTS calls and across reruns, instead of paying a new TCP/TLS handshake each
+# time, and multiplexes the parallel TTS requests over that one connection.
+@st.cache_resource
+def get_event_loop():
+    """
+    Starts an event loop on a daemon thread that outlives individual reruns.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """
+    Runs a coroutine on the shared event loop and waits for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+def iter_async(agen):
+    """
+    Iterates an async generator from the script thread, fetching each item on
+    the shared event loop. Callers should close it explicitly (e.g. with
+    contextlib.closing) so an interrupted run releases the generator at once.
+    """
+    loop = get_event_loop()
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        closing = asyncio.run_coroutine_threadsafe(agen.aclose(), loop)
+        # If the garbage collector finalizes this generator on the loop thread
+        # itself, waiting for aclose() there would block the loop forever
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is not loop:
+            closing.result()
+
+@st.cache_resource
+def get_client():
+    """
+    Returns the httpx client shared by all Gemini API calls.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=60.0,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60),
+    )
+
+# --- Reusable scratch buffers for decoded PCM audio ---
+class PcmBufferPool:
+    """
+    A small free list of bytearrays that decoded TTS audio is assembled in, so
+    multi-megabyte buffers are reused across generations instead of being
+    reallocated and grown for each one. Only large buffers are kept; smaller
+    ones are left to CPython's own allocator.
+    """
+    MIN_POOLED_SIZE = 64 * 1024
+
+    def __init__(self, max_buffers=8):
+        self._buffers = collections.deque(maxlen=max_buffers)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            return self._buffers.pop() if self._buffers else bytearray()
+
+    def release(self, buffer):
+        if len(buffer) >= self.MIN_POOLED_SIZE:
+            with self._lock:
+                self._buffers.append(buffer)
+
+@st.cache_resource
+def get_pcm_pool():
+    """
+    Returns the PCM buffer pool shared across reruns.
+    """
+    return PcmBufferPool()
+
+# --- Helper to surface Gemini API errors ---
+async def raise_for_gemini_status(response):
+    """
+    Raises httpx.HTTPStatusError for an unsuccessful response, carrying the
+    error message from the Gemini API body (e.g. "API key not valid") instead of
+    the generic HTTP reason phrase. The body is only decoded as a story or audio
+    once the status check has passed.
+    """
+    if response.is_success:
+        return
+    await response.aread()
+    try:
+        message = orjson.loads(response.content)['error']['message']
+    except (ValueError, KeyError, TypeError):
+        message = httpx.codes.get_reason_phrase(response.status_code)
+    raise httpx.HTTPStatusError(
+        f"{response.status_code}: {message}", request=response.request, response=response
+    )
+
+# --- Helper to read a Server-Sent Events response from the Gemini API ---
+async def iter_sse_events(response):
+    """
+    Yields the raw JSON payload of each `data:` line of an SSE response.
+    Lines are split out of the raw byte stream, so multi-megabyte audio events
+    are never decoded to str along the way.
+    """
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        end = buffer.rfind(b"\n")
+        if end < 0:
+            continue
+        for line in buffer[:end].split(b"\n"):
+            if line.startswith(b"data:"):
+                yield line[5:]
+        del buffer[:end + 1]
+    if buffer.startswith(b"data:"):
+        yield bytes(buffer[5:])
 
 # --- Function to generate story text using the Gemini API ---
-def generate_story(prompt, api_key):
+class EmptyStory(Exception):
+    """
+    Raised when the Gemini API finishes without writing any story text, e.g.
+    when the reply was stopped by a safety filter.
+    """
+
+async def generate_story_stream(client, prompt, api_key):
     """
-    Calls the Gemini API to generate a story based on the provided prompt.
+    Calls the Gemini API to generate a story based on the provided prompt,
+    yielding the text as it is generated so it can be shown right away.
+    Raises httpx.HTTPError if the request fails, EmptyStory if the reply has no
+    story text and KeyError/IndexError if the response is malformed.
     """
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{TEXT_GENERATION_MODEL}:generateContent?key={api_key}"
-    # New system prompt for bedtime stories
-    system_prompt = "You are a gentle and soothing storyteller, specializing in creating calming and imaginative bedtime stories for children. The stories should be a few paragraphs long and have a happy, reassuring ending."
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{TEXT_GENERATION_MODEL}:streamGenerateContent?alt=sse"
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
-        "systemInstruction": {"parts": [{"text": system_prompt}]},
+        "systemInstruction": STORY_SYSTEM_INSTRUCTION,
     }
-    
+
+    async with client.stream("POST", url, json=payload, headers={"x-goog-api-key": api_key}) as response:
+        await raise_for_gemini_status(response)
+        has_text = False
+        finish_reason = None
+        async for data in iter_sse_events(response):
+            event = orjson.loads(data)
+            candidate = event['candidates'][0]
+            finish_reason = candidate.get('finishReason', finish_reason)
+            for part in candidate.get('content', {}).get('parts', []):
+                if part.get('text'):
+                    has_text = has_text or not part['text'].isspace()
+                    yield part['text']
+
+    if not has_text:
+        raise EmptyStory(f"No story was written (finish reason: {finish_reason or 'unknown'}). Try different story details.")
+
+# --- Single-flight story generation ---
+# A double click on "Generate Story", or a rerun while a story is still being
+# written, would otherwise send the same request again. Instead, each prompt has
+# at most one generation in flight and every caller follows that one. Flights are
+# only touched from the shared event loop, which serializes access to them. A
+# flight stores its finished story itself, so the story is kept even when the
+# run that started it was interrupted and nobody is following it anymore.
+class StoryFlight:
+    """
+    One in-flight story generation, produced by a single task on the event
+    loop. Any number of callers can follow it: each gets the text generated so
+    far, then the rest as it arrives.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.error = None
+        self.done = False
+        self.changed = asyncio.Condition()
+        self.task = None
+
+    async def run(self, stream, store):
+        try:
+            async for chunk in stream:
+                async with self.changed:
+                    self.chunks.append(chunk)
+                    self.changed.notify_all()
+            # Stored before followers are told the story is done, so a run that
+            # finishes following it finds the story in the cache
+            await asyncio.to_thread(store, "".join(self.chunks))
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self.changed:
+                self.done = True
+                self.changed.notify_all()
+
+    async def follow(self):
+        index = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: index < len(self.chunks) or self.done)
+            if index < len(self.chunks):
+                index += 1
+                yield self.chunks[index - 1]
+            elif self.error is not None:
+                raise self.error
+            else:
+                return
+
+@st.cache_resource
+def get_story_flights():
+    """
+    Returns the in-flight story generations, keyed by prompt digest.
+    """
+    return {}
+
+async def follow_story(flights, prompt_digest, client, prompt, api_key, store):
+    """
+    Yields the story for a prompt as it is generated, joining the generation
+    already in flight for the same prompt or starting a new one. A new
+    generation passes its finished story to store.
+    Raises the same errors as generate_story_stream.
+    """
+    flight = flights.get(prompt_digest)
+    if flight is None:
+        flight = flights[prompt_digest] = StoryFlight()
+        flight.task = asyncio.create_task(
+            flight.run(generate_story_stream(client, prompt, api_key), store)
+        )
+        flight.task.add_done_callback(lambda _: flights.pop(prompt_digest, None))
+    async for chunk in flight.follow():
+        yield chunk
+
+# --- Helper to wrap raw PCM audio as WAV ---
+def wav_header(pcm_length, sample_rate):
+    """
+    Builds the 44-byte RIFF/WAVE header for 16-bit mono PCM audio, so the PCM
+    can be used as-is without going through the wave module.
+    """
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + pcm_length, b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,  # PCM, mono, 16-bit
+        b'data', pcm_length,
+    )
+
+# --- CPU-bound audio steps, run off the event loop with asyncio.to_thread ---
+# Parsing a large audio event, decoding its base64 and joining megabytes of PCM
+# would otherwise hold up every other paragraph streaming on the event loop.
+def decode_audio_event(data):
+    """
+    Parses one SSE event of a TTS response and decodes its base64 audio.
+    Returns a list of (mime_type, pcm) pairs.
+    """
+    event = orjson.loads(data)
+    return [
+        (part['inlineData']['mimeType'], base64.b64decode(part['inlineData']['data']))
+        for part in event['candidates'][0].get('content', {}).get('parts', [])
+        if 'inlineData' in part
+    ]
+
+def assemble_wav(sample_rate, passages):
+    """
+    Joins the WAV header and the PCM of every (buffer, pcm_length) passage in a
+    single allocation.
+    """
+    pcm_length = sum(length for _, length in passages)
+    views = [memoryview(buffer)[:length] for buffer, length in passages]
     try:
-        response = requests.post(url, json=payload)
-        response.raise_for_status()
-        result = response.json()
-        story_text = result['candidates'][0]['content']['parts'][0]['text']
-        return story_text
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error generating story. Check your API key and try again: {e}")
-        return None
-
-# --- Function to generate TTS audio using the Gemini API ---
-def text_to_speech(text, api_key):
+        return b"".join([wav_header(pcm_length, sample_rate), *views])
+    finally:
+        for view in views:
+            view.release()
+
+# --- Functions to generate TTS audio using the Gemini API ---
+async def speak_passage(client, pcm_pool, text, api_key):
     """
-    Converts a story text to audio using the Gemini TTS API.
-    Returns the audio data in a BytesIO object and the sample rate.
+    Converts one passage of text to audio using the Gemini TTS API.
+    The audio is streamed and each chunk is decoded as it arrives, instead of
+    buffering the whole base64 response first. The PCM is written into a buffer
+    borrowed from pcm_pool, which the caller must release.
+    Returns (sample_rate, buffer, pcm_length). Raises httpx.HTTPError if the
+    request fails and KeyError/IndexError if the response is malformed.
     """
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{TTS_MODEL}:generateContent?key={api_key}"
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{TTS_MODEL}:streamGenerateContent?alt=sse"
     payload = {
         "contents": [{"parts": [{"text": text}]}],
-        "generationConfig": {
-            "responseModalities": ["AUDIO"],
-            "speechConfig": {
-                "voiceConfig": {
-                    "prebuiltVoiceConfig": {"voiceName": "Puck"} # Upbeat voice
-                }
-            }
-        }
+        "generationConfig": TTS_GENERATION_CONFIG,
     }
+    sample_rate = None
+    pcm_length = 0
+    buffer = pcm_pool.acquire()
     try:
-        response = requests.post(url, json=payload)
-        response.raise_for_status()
-        result = response.json()
-        
-        audio_data_b64 = result['candidates'][0]['content']['parts'][0]['inlineData']['data']
-        mime_type = result['candidates'][0]['content']['parts'][0]['inlineData']['mimeType']
-        
-        # Decode the base64 audio data
-        audio_data_pcm = base64.b64decode(audio_data_b64)
-        
-        # Extract sample rate from mime type (e.g., audio/L16;rate=24000)
-        sample_rate_str = mime_type.split('rate=')[1]
-        sample_rate = int(sample_rate_str)
-        
-        # Convert raw PCM data to WAV format in memory
-        with io.BytesIO() as audio_io:
-            with wave.open(audio_io, 'wb') as wav_file:
-                wav_file.setnchannels(1)  # Mono audio
-                wav_file.setsampwidth(2)  # 16-bit
-                wav_file.setframerate(sample_rate)
-                wav_file.writeframes(audio_data_pcm)
-            
-            audio_io.seek(0)
-            return audio_io.read()
-            
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error generating audio. Check your API key and try again: {e}")
-        return None
-    except (KeyError, IndexError) as e:
-        st.error(f"Unexpected API response structure: {e}")
-        return None
-
-# --- Web Speech API (Voice Input) Component ---
-def voice_input():
-    """
-    A small HTML/JS component to handle voice input via the Web Speech API.
-    It uses a trick with st.session_state to pass the result back to Python.
-    """
-    if 'voice_text' not in st.session_state:
-        st.session_state.voice_text = ""
-
-    html_code = f"""
-    <div style="text-align: center;">
-        <button id="voice-input-btn" 
-                style="background-color: transparent; border: 2px solid #5A4E8F; color: #5A4E8F; padding: 10px 20px; text-align: center; text-decoration: none; display: inline-block; font-size: 16px; margin: 4px 2px; cursor: pointer; border-radius: 12px; font-family: sans-serif;">
-            <span style="font-size: 24px;">🎙️</span> Voice Input
-        </button>
-    </div>
-    <script>
-        const voiceBtn = document.getElementById('voice-input-btn');
-        if ('webkitSpeechRecognition' in window) {{
-            const recognition = new webkitSpeechRecognition();
-            recognition.continuous = false;
-            recognition.interimResults = false;
-            recognition.lang = 'en-US';
-
-            recognition.onresult = (event) => {{
-                const transcript = event.results[0][0].transcript;
-                const url = new URL(window.location.href);
-                url.searchParams.set('voice_input', transcript);
-                window.location.href = url.toString();
-            }};
-
-            recognition.onerror = (event) => {{
-                console.error("Speech recognition error:", event.error);
-                alert("Speech recognition error: " + event.error);
-            }};
-
-            voiceBtn.onclick = () => {{
-                recognition.start();
-            }};
-        }} else {{
-            voiceBtn.style.display = 'none';
-            alert('Your browser does not support Web Speech API.');
-        }}
-    </script>
-    """
-    st.html(html_code)
+        async with client.stream("POST", url, json=payload, headers={"x-goog-api-key": api_key}) as response:
+            await raise_for_gemini_status(response)
+            async for data in iter_sse_events(response):
+                # Decode each chunk of base64 PCM as it arrives
+                for mime_type, pcm in await asyncio.to_thread(decode_audio_event, data):
+                    if sample_rate is None:
+                        # Extract sample rate from mime type (e.g., audio/L16;rate=24000)
+                        sample_rate = int(mime_type.split('rate=')[1])
+                    # The buffer only grows when it is smaller than the audio so far
+                    buffer[pcm_length:pcm_length + len(pcm)] = pcm
+                    pcm_length += len(pcm)
+
+        if sample_rate is None:
+            raise KeyError('inlineData')
+    except BaseException:
+        pcm_pool.release(buffer)
+        raise
+    return sample_rate, buffer, pcm_length
+
+class NothingToNarrate(Exception):
+    """
+    Raised by Narration.finish when the text had nothing to read aloud.
+    """
+
+class Narration:
+    """
+    Collects the audio for a story passage by passage. Each passage is sent to
+    the TTS API as soon as it is added, up to TTS_MAX_CONCURRENT_REQUESTS at a
+    time, so passages can be added while the story is still being written.
+    finish() waits for them and joins the PCM in order.
+    """
+
+    def __init__(self, client, pcm_pool, api_key):
+        self.client = client
+        self.pcm_pool = pcm_pool
+        self.api_key = api_key
+        # Created by the first add() rather than here: a narration is set up on
+        # the script thread, and before Python 3.10 a semaphore binds to the
+        # event loop of the thread that creates it
+        self.semaphore = None
+        self.tasks = []
+
+    def add(self, passage):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(TTS_MAX_CONCURRENT_REQUESTS)
+        if passage.strip():
+            self.tasks.append(asyncio.create_task(self._speak(passage.strip())))
+
+    async def _speak(self, passage):
+        async with self.semaphore:
+            return await speak_passage(self.client, self.pcm_pool, passage, self.api_key)
+
+    def cancel(self):
+        """
+        Cancels the passages still being synthesized. Buffers of passages that
+        already finished go back to the pool, and their errors are consumed
+        rather than logged as never retrieved. Calling it again does nothing.
+        """
+        for task in self.tasks:
+            if task.done():
+                self._discard(task)
+            else:
+                task.cancel()
+                task.add_done_callback(self._discard)
+        self.tasks.clear()
+
+    def _discard(self, task):
+        if task.cancelled() or task.exception() is not None:
+            return
+        _, buffer, _ = task.result()
+        self.pcm_pool.release(buffer)
+
+    async def finish(self):
+        """
+        Returns the audio as WAV bytes. Raises NothingToNarrate if no passage
+        with text was added, httpx.HTTPError if a request failed and
+        KeyError/IndexError if a response was malformed.
+        """
+        if not self.tasks:
+            raise NothingToNarrate("The story has no text to read aloud.")
+        results = await asyncio.gather(*self.tasks, return_exceptions=True)
+        passages = [r for r in results if not isinstance(r, BaseException)]
+        try:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            sample_rate = passages[0][0]
+            return await asyncio.to_thread(
+                assemble_wav, sample_rate, [(buffer, length) for _, buffer, length in passages]
+            )
+        finally:
+            for _, buffer, _ in passages:
+                self.pcm_pool.release(buffer)
+
+async def text_to_speech(client, pcm_pool, text, api_key):
+    """
+    Converts a story text to audio using the Gemini TTS API.
+    Each paragraph is synthesized by its own request, up to
+    TTS_MAX_CONCURRENT_REQUESTS at a time, and the PCM is joined in order.
+    Returns the audio as WAV bytes. Raises NothingToNarrate if the text is
+    empty, httpx.HTTPError if a request fails and KeyError/IndexError if a
+    response is malformed.
+    """
+    narration = Narration(client, pcm_pool, api_key)
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        narration.add(paragraph)
+    return await narration.finish()
+
+async def narrate_while_writing(chunks, narration):
+    """
+    Passes story chunks through unchanged, handing each paragraph to narration
+    as soon as it is complete, so its audio is synthesized while the rest of
+    the story is still being written. The paragraphs are split the same way as
+    in text_to_speech. If the story stream fails or is abandoned, the pending
+    narration requests are cancelled.
+    """
+    pending = ""
+    try:
+        async for chunk in chunks:
+            pending += chunk
+            *paragraphs, pending = PARAGRAPH_BREAK.split(pending)
+            for paragraph in paragraphs:
+                narration.add(paragraph)
+            yield chunk
+        narration.add(pending)
+    except BaseException:
+        narration.cancel()
+        raise
+
+# --- Cached entry points used by the UI ---
+# Streamlit reruns the whole script on every widget change, so identical story
+# and audio requests are answered from a cache that also persists to disk.
+# Underscore-prefixed arguments are excluded from the cache key: long texts are
+# keyed by their digest instead, and the API key is never part of the key.
+def digest(text):
+    """
+    Returns a short, stable hash of a text for use as a cache key.
+    """
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+class StoryCacheMiss(Exception):
+    """
+    Raised by cached_story when no story has been stored for a prompt yet.
+    """
+
+# Stories are streamed to the page as they are generated, which a cached
+# function cannot do, so this cache is filled explicitly once a flight finishes.
+@st.cache_data(show_spinner=False, persist="disk", max_entries=256)
+def cached_story(prompt_digest, model, _story=None):
+    """
+    Returns the story stored for a prompt, or raises StoryCacheMiss. Calling it
+    with _story on a miss stores that story under the prompt's key.
+    """
+    if _story is None:
+        raise StoryCacheMiss(prompt_digest)
+    return _story
+
+# Audio entries are hundreds of kilobytes to megabytes each, so fewer are kept.
+@st.cache_data(show_spinner=False, persist="disk", max_entries=32)
+def cached_speech(text_digest, model, voice, _text, _api_key, _audio=None):
+    """
+    Returns the finished WAV bytes for a text, calling the Gemini API on a cache miss.
+    Calling it with _audio on a miss stores that audio instead, e.g. narration
+    that was already synthesized while the story was written.
+    """
+    if _audio is not None:
+        return _audio
+    return run_async(text_to_speech(get_client(), get_pcm_pool(), _text, _api_key))
 
 # --- UI Layout and Logic ---
 st.title("🌙 Bedtime Story Weaver")
@@ -155,20 +528,18 @@ with st.sidebar:
         st.warning("Please enter your API key to proceed. You can get one from the Google AI Studio.")
     st.markdown("---")
     
-    # Text input for voice transcription
-    voice_input_param = st.query_params.get('voice_input')
-    if voice_input_param:
-        st.session_state.voice_text = voice_input_param
-        st.query_params.clear()
-        
-    st.text_area(
+    # Text input for voice transcription, filled in from the microphone button below
+    voice_input_area = st.empty()
+    voice_message = voice_input()
+    if voice_message and voice_message["id"] != st.session_state.get("voice_input_id"):
+        st.session_state.voice_input_id = voice_message["id"]
+        st.session_state.voice_input_area = voice_message["transcript"]
+
+    voice_input_area.text_area(
         "Voice Input",
-        value=st.session_state.get('voice_text', ""),
         help="Use the microphone button below to speak your input.",
         key="voice_input_area"
     )
-    
-    voice_input()
 
     st.markdown("---")
     characters = st.text_input("Enter the main characters (e.g., A sleepy bear, a gentle firefly)")
@@ -176,39 +547,117 @@ with st.sidebar:
     age_group = st.selectbox("Select the age group", ["Toddlers (1-3 years)", "Children (4-8 years)"])
     tips = st.text_area("Additional tips (e.g., 'Make it snow,' 'Include a friendly owl')")
     
+    narrate_while_written = st.checkbox(
+        "Read the story aloud as it's written",
+        help="Prepares the audio alongside the story, so it is ready as soon as the story is.",
+    )
+
     generate_button = st.button("Generate Story", type="primary")
 
 # --- Main Content Area ---
+story_prompt = None
 if generate_button:
     if not api_key:
         st.error("Please enter your Gemini API key in the sidebar.")
     elif not characters:
         st.error("Please enter at least one character to get started.")
     else:
-        # Construct the full prompt for the LLM
-        story_prompt = f"Create a story for the following details:\n\n"
-        story_prompt += f"Characters: {characters}\n"
-        story_prompt += f"Genre: {genre}\n"
-        story_prompt += f"Age Group: {age_group}\n"
+        # Construct the full prompt for the LLM in a single join
+        prompt_lines = [
+            "Create a story for the following details:",
+            "",
+            f"Characters: {characters}",
+            f"Genre: {genre}",
+            f"Age Group: {age_group}",
+        ]
         if tips:
-            story_prompt += f"Additional Tips: {tips}\n"
-        
-        with st.spinner("Weaving a peaceful tale..."):
-            story = generate_story(story_prompt, api_key)
-            if story:
-                st.session_state.story_text = story
+            prompt_lines.append(f"Additional Tips: {tips}")
+        story_prompt = "\n".join(prompt_lines) + "\n"
 
-if "story_text" in st.session_state:
-    st.markdown("---")
-    st.markdown("### Your Bedtime Story")
+story_heading_shown = False
+
+def story_heading():
+    """
+    Renders the heading above the story, once there is a story to show. Only
+    the first call in a run renders anything, e.g. when a stream fails partway
+    and the previous story is shown instead.
+    """
+    global story_heading_shown
+    if not story_heading_shown:
+        st.markdown("---")
+        st.markdown("### Your Bedtime Story")
+        story_heading_shown = True
+
+def narrate_story(story_text, narration=None):
+    """
+    Stores the audio for a story in session state, showing any error on the
+    page. Uses the narration's audio if the story was narrated while it was
+    written, and the speech cache otherwise.
+    """
+    with st.spinner("Generating soothing audio..."):
+        try:
+            narrated_audio = run_async(narration.finish()) if narration else None
+            st.session_state.story_audio = cached_speech(
+                digest(story_text), TTS_MODEL, TTS_VOICE, story_text, api_key,
+                _audio=narrated_audio,
+            )
+        except httpx.HTTPError as e:
+            st.error(f"Error generating audio. Check your API key and try again: {e}")
+        except NothingToNarrate as e:
+            st.error(str(e))
+        except (KeyError, IndexError) as e:
+            st.error(f"Unexpected API response structure: {e}")
+
+new_story = None
+narration = None
+if story_prompt:
+    prompt_digest = digest(story_prompt)
+    try:
+        new_story = cached_story(prompt_digest, TEXT_GENERATION_MODEL)
+        story_heading()
+        st.markdown(new_story)
+    except StoryCacheMiss:
+        story_stream = follow_story(
+            get_story_flights(), prompt_digest, get_client(), story_prompt, api_key,
+            store=functools.partial(cached_story, prompt_digest, TEXT_GENERATION_MODEL),
+        )
+        if narrate_while_written:
+            narration = Narration(get_client(), get_pcm_pool(), api_key)
+            story_stream = narrate_while_writing(story_stream, narration)
+        try:
+            # Closed here rather than left to the garbage collector, so a rerun
+            # that interrupts the stream releases it right away
+            with contextlib.closing(iter_async(story_stream)) as chunks:
+                # Only the wait for the first words is covered by the spinner
+                with st.spinner("Weaving a peaceful tale..."):
+                    first_chunk = next(chunks, "")
+                story_heading()
+                new_story = st.write_stream(itertools.chain([first_chunk], chunks))
+        except httpx.HTTPError as e:
+            st.error(f"Error generating story. Check your API key and try again: {e}")
+        except EmptyStory as e:
+            st.error(str(e))
+        except (KeyError, IndexError) as e:
+            st.error(f"Unexpected API response structure: {e}")
+
+if new_story is not None:
+    st.session_state.story_text = new_story
+    st.session_state.pop("story_audio", None)
+    if narrate_while_written:
+        # A story from the cache has no narration yet; it is looked up or
+        # synthesized as if "Tell Me the Story" had been pressed
+        narrate_story(new_story, narration)
+elif "story_text" in st.session_state:
+    story_heading()
     st.markdown(st.session_state.story_text)
-    
+
+if "story_text" in st.session_state:
     col1, col2 = st.columns([1, 10])
     with col1:
         if st.button("🔊 Tell Me the Story"):
-            with st.spinner("Generating soothing audio..."):
-                audio_data = text_to_speech(st.session_state.story_text, api_key)
-                if audio_data:
-                    st.audio(audio_data, format="audio/wav")
+            narrate_story(st.session_state.story_text)
+        # Kept in session state so the player survives reruns from other widgets
+        if "story_audio" in st.session_state:
+            st.audio(st.session_state.story_audio, format="audio/wav")
     with col2:
         st.write("Click to have the story read aloud.")
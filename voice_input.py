@@ -0,0 +1,22 @@
+"""
+Web Speech API (Voice Input) Component.
+
+Declared in its own module so the declaration runs once per process on import,
+rather than on every rerun of the Streamlit script.
+"""
+import os
+
+import streamlit.components.v1 as components
+
+voice_input_component = components.declare_component(
+    "voice_input", path=os.path.join(os.path.dirname(__file__), "components", "voice_input")
+)
+
+def voice_input():
+    """
+    A small HTML/JS component to handle voice input via the Web Speech API.
+    The transcript is sent back as the component's value, so it reaches Python
+    without reloading the page and starting a new session.
+    Returns the latest {"transcript", "id"} message, or None before any input.
+    """
+    return voice_input_component(key="voice_input", default=None)